@@ -0,0 +1,178 @@
+# agent_runner.py
+# Agent assembly, batch mode, streaming output and the CLI shared by agent.py and agent-azure.py.
+# Those files only construct their LLM and hand it to build_agent_executor().
+import os
+import sys
+import time
+import asyncio
+import argparse
+from typing import TYPE_CHECKING, Callable, List
+from dotenv import load_dotenv
+
+if TYPE_CHECKING:
+    from langchain.agents import AgentExecutor
+    from langchain_core.language_models import BaseChatModel
+
+# Number of batch queries sent to the LLM backend at once. This only helps if the backend serves
+# requests concurrently (for Ollama, start the server with OLLAMA_NUM_PARALLEL >= this value).
+BATCH_MAX_CONCURRENCY = 10
+
+# Tokens are collected and flushed at most every STREAM_FLUSH_INTERVAL seconds, so the answer
+# appears as it is generated without paying a write + flush per token.
+STREAM_FLUSH_INTERVAL = 0.05
+
+def build_agent_executor(llm: "BaseChatModel") -> "AgentExecutor":
+    """Wraps `llm` into the Loki tool-calling agent, with the LLM response cache installed."""
+    # LangChain and the Loki tool are imported here rather than at the top of the module,
+    # so `--help` and argument parsing don't pay for loading them.
+    from langchain.agents import AgentExecutor
+    from langchain.agents.format_scratchpad.tools import format_to_tool_messages
+    from langchain.agents.output_parsers.tools import ToolsAgentOutputParser
+    from langchain_core.runnables import RunnablePassthrough
+    from langchain_core.globals import set_llm_cache
+    from langchain_community.cache import SQLiteCache
+    from prompts import AGENT_PROMPT # Precompiled, cache-friendly agent prompt
+    from loki_tool import query_loki_logs # Import your Loki tool
+
+    # --- 1. Cache LLM responses ---
+    # Identical prompts (same messages, model and parameters) are answered from the cache
+    # instead of calling the LLM again, which makes re-asked questions and agent retries near-instant.
+    # Set REDIS_URL to share the cache between processes/hosts; otherwise a local SQLite file is used.
+    if os.getenv("REDIS_URL"):
+        import redis
+        from langchain_community.cache import RedisCache
+        set_llm_cache(RedisCache(redis.Redis.from_url(os.getenv("REDIS_URL"))))
+    else:
+        set_llm_cache(SQLiteCache(database_path=os.getenv("LLM_CACHE_PATH", ".langchain_cache.db")))
+
+    # --- 2. Define the Tools available to the agent ---
+    tools = [query_loki_logs]
+
+    # --- 3. Create the Tool-Calling Agent ---
+    # AGENT_PROMPT is compiled once in prompts.py, so per call this chain only merges the
+    # input dict and formats the scratchpad. Equivalent to create_tool_calling_agent, minus
+    # re-validating the prompt every time an agent is built.
+    agent = (
+        RunnablePassthrough.assign(
+            agent_scratchpad=lambda x: format_to_tool_messages(x["intermediate_steps"])
+        )
+        | AGENT_PROMPT
+        | llm.bind_tools(tools)
+        | ToolsAgentOutputParser()
+    )
+
+    # --- 4. Create the Agent Executor ---
+    # stream_runnable=False makes the executor call the LLM through invoke, which consults the LLM
+    # cache; the streamed code path bypasses it. Tokens are still streamed to astream_events
+    # listeners on a cache miss, so stream_response keeps working.
+    # verbose=True is highly recommended for debugging agent's thought process
+    return AgentExecutor(agent=agent, tools=tools, verbose=True, stream_runnable=False)
+
+def run_batch(agent_executor: "AgentExecutor", queries: List[str], max_concurrency: int = BATCH_MAX_CONCURRENCY) -> List:
+    """Runs several queries through the agent concurrently and returns their results in order."""
+    return agent_executor.batch(
+        [{"input": q} for q in queries],
+        config={"max_concurrency": max_concurrency},
+        return_exceptions=True,
+    )
+
+async def arun_batch(agent_executor: "AgentExecutor", queries: List[str], max_concurrency: int = BATCH_MAX_CONCURRENCY) -> List:
+    """Async counterpart of run_batch."""
+    return await agent_executor.abatch(
+        [{"input": q} for q in queries],
+        config={"max_concurrency": max_concurrency},
+        return_exceptions=True,
+    )
+
+async def _run_batch_file(agent_executor: "AgentExecutor", path: str, max_concurrency: int):
+    # One query per line; blank lines are skipped. "-" reads from stdin.
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    with f:
+        queries = [line.strip() for line in f if line.strip()]
+
+    results = await arun_batch(agent_executor, queries, max_concurrency=max_concurrency)
+    for query, result in zip(queries, results):
+        print(f"\n--- Query: {query} ---")
+        if isinstance(result, Exception):
+            print(f"Error: {result}")
+        else:
+            print(result["output"])
+        print("----------------------")
+
+async def stream_response(agent_executor: "AgentExecutor", user_input: str):
+    """Prints the agent's answer to `user_input` as it is generated."""
+    buffer = []
+    last_flush = time.monotonic()
+
+    def flush():
+        nonlocal last_flush
+        if buffer:
+            print("".join(buffer), end="", flush=True)
+            buffer.clear()
+        last_flush = time.monotonic()
+
+    streamed_answer = False
+    async for event in agent_executor.astream_events({"input": user_input}, version="v2"):
+        if event["event"] == "on_chat_model_stream":
+            content = event["data"]["chunk"].content
+            if content:
+                streamed_answer = True
+                buffer.append(content)
+                if time.monotonic() - last_flush >= STREAM_FLUSH_INTERVAL:
+                    flush()
+        elif event["event"] == "on_tool_start":
+            # Surface the agent's tool-call planning while it waits on Loki.
+            flush()
+            streamed_answer = False
+            print(f"\n[Calling {event['name']} with {event['data'].get('input')}]", flush=True)
+        elif event["event"] == "on_chain_end" and not event["parent_ids"] and not streamed_answer:
+            # Answers served from the LLM cache produce no token events; print the final output instead.
+            buffer.append(event["data"]["output"]["output"])
+    flush()
+    print()
+
+async def main(build_agent: Callable[[], "AgentExecutor"], title: str):
+    """
+    Runs the command line interface: the interactive REPL, or --batch mode.
+
+    Args:
+        build_agent: Returns the agent executor; only called once the arguments are parsed.
+        title: Banner printed when the REPL starts.
+    """
+    # Load .env here rather than on import, so importing the agent modules has no side effects.
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Query Grafana Loki logs using natural language.")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="Run the queries in FILE (one per line, '-' for stdin) concurrently and exit.")
+    parser.add_argument("--max-concurrency", type=int, default=BATCH_MAX_CONCURRENCY,
+                        help=f"Maximum number of batch queries in flight at once (default: {BATCH_MAX_CONCURRENCY}).")
+    args = parser.parse_args()
+
+    if args.batch:
+        await _run_batch_file(build_agent(), args.batch, args.max_concurrency)
+        return
+
+    print(title)
+    print("I can help you query logs from Grafana Loki using natural language.")
+    print("Examples: ")
+    print("  - 'Show me the last 100 system logs from the last 30 minutes.'")
+    print("  - 'Find all error messages in nginx logs from yesterday.'")
+    print("  - 'Count errors by application in the last hour.'")
+    print("Type 'exit' to quit.")
+
+    while True:
+        user_input = await asyncio.to_thread(input, "\nYour query: ")
+        if user_input.lower() == 'exit':
+            print("Goodbye!")
+            break
+
+        try:
+            # Stream the answer as it is generated; the async Loki tool overlaps network I/O
+            print("\n--- Agent Response ---")
+            await stream_response(build_agent(), user_input)
+            print("----------------------")
+        except Exception as e:
+            print(f"\n--- An error occurred ---")
+            print(f"Error: {e}")
+            print("-------------------------")
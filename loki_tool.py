@@ -1,22 +1,545 @@
 # loki_tool.py
 import os
+import asyncio
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING as URLLIB3_ACCEPT_ENCODING
 import json
-from datetime import datetime, timedelta
+import time
+import orjson
+import ijson
+import tiktoken
+import threading
+import weakref
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from dotenv import load_dotenv
-from langchain_core.tools import tool
-from typing import Optional
+from drain3 import TemplateMiner
+from drain3.template_miner_config import TemplateMinerConfig
+from langchain_core.tools import StructuredTool
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+from typing import AsyncGenerator, Callable, Dict, List, Literal, Optional, Tuple
 
-load_dotenv()
+DEFAULT_LOKI_URL = "http://localhost:3100" # Used when LOKI_URL is not set
+LOKI_TIMEOUT = (3.05, 30) # (connect, read) timeouts in seconds
+TIMESTAMP_FORMAT = "%d-%02d-%02d %02d:%02d:%02d" # YYYY-MM-DD HH:MM:SS (local time) in the tool output
+NS_PER_SECOND = 1_000_000_000
+# Ask Loki for compressed responses. zstd is only advertised when urllib3 (and therefore httpx,
+# which checks the same `zstandard` package) can decode it; otherwise a zstd body would be passed
+# through undecoded and fail to parse.
+LOKI_HEADERS = {"Accept-Encoding": "zstd, gzip" if "zstd" in URLLIB3_ACCEPT_ENCODING else "gzip"}
+# Metric queries over more than LOKI_SHARD_THRESHOLD_MINUTES are split into LOKI_SHARD_MINUTES
+# sub-ranges that are queried concurrently (at most LOKI_QUERY_PARALLELISM at a time)
+LOKI_SHARD_THRESHOLD_MINUTES = 30
+LOKI_SHARD_MINUTES = 15
+DEFAULT_QUERY_PARALLELISM = 8
+# Size of the HTTP connection pools. It also caps concurrent Loki requests process-wide, across
+# tool calls (e.g. in --batch mode), so requests wait for a free connection instead of opening
+# extra connections or failing with a pool timeout.
+LOKI_MAX_CONNECTIONS = 10
+# Responses to queries with at least this limit are decoded incrementally while they are
+# received, instead of buffering the whole body and parsing it in one go (see _IncrementalDecoder)
+LOKI_STREAM_DECODE_MIN_LIMIT = 1000
+STREAM_CHUNK_SIZE = 64 * 1024
+# Identical tool calls (same arguments, same minute) within LOKI_RESULT_CACHE_TTL seconds
+# are answered from memory instead of querying Loki again
+LOKI_RESULT_CACHE_SIZE = 256
+LOKI_RESULT_CACHE_TTL = 30
+# Upper bound on the size of a tool result, in tokens (override with LOKI_TOKEN_BUDGET).
+# Larger results are truncated from the tail so LLM context and time-to-first-token stay bounded.
+DEFAULT_TOKEN_BUDGET = 3000
+CHARS_PER_TOKEN = 4 # Rough estimate used when the tiktoken encoding is unavailable
+# How much of an unparseable response body is quoted back to the LLM (the body can be megabytes)
+ERROR_BODY_PREVIEW_CHARS = 200
 
-LOKI_URL = os.getenv("LOKI_URL", "http://localhost:3100") # Default Loki URL
+# Shared HTTP session for the lifetime of the process, so keep-alive connections
+# to Loki are reused across tool calls instead of paying a TCP/TLS handshake each time.
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(pool_connections=10, pool_maxsize=LOKI_MAX_CONNECTIONS)
+_SESSION.mount("http://", _ADAPTER)
+_SESSION.mount("https://", _ADAPTER)
+_SESSION.headers.update(LOKI_HEADERS)
+# Held for the duration of each request on _SESSION, by every thread
+_SESSION_SLOTS = threading.BoundedSemaphore(LOKI_MAX_CONNECTIONS)
 
-@tool
-def query_loki_logs(
+# Async clients for the coroutine variant of the tool, one per event loop; see _get_async_client().
+# Values are (client, slots, closer): slots caps the loop's concurrent requests at the client's
+# pool size, and closer is the async generator that closes the client.
+_ASYNC_CLIENTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Tuple[httpx.AsyncClient, asyncio.Semaphore, AsyncGenerator]]" = weakref.WeakKeyDictionary()
+
+# Recent tool results, keyed by _result_cache_key(); values are (stored_at, result).
+_RESULT_CACHE: "OrderedDict[tuple, Tuple[float, str]]" = OrderedDict()
+_RESULT_CACHE_LOCK = threading.Lock()
+
+def _loki_url() -> str:
+    # Read on every call rather than at import, so a .env loaded by the caller is honoured.
+    return os.getenv("LOKI_URL", DEFAULT_LOKI_URL)
+
+def _query_parallelism() -> int:
+    return max(1, int(os.getenv("LOKI_QUERY_PARALLELISM", DEFAULT_QUERY_PARALLELISM)))
+
+def _result_cache_key(query: str, time_range_minutes: int, limit: int, direction: str, end_ns: int) -> tuple:
+    # The end of the range is quantized to the minute, so an agent repeating (or self-correcting
+    # back to) the same call shortly after gets the same answer instead of another Loki round trip.
+    return (query, time_range_minutes, limit, direction, end_ns // (60 * NS_PER_SECOND))
+
+def _cached_result(key: tuple) -> Optional[str]:
+    with _RESULT_CACHE_LOCK:
+        hit = _RESULT_CACHE.get(key)
+        if hit is None:
+            return None
+        stored_at, result = hit
+        if time.monotonic() - stored_at > LOKI_RESULT_CACHE_TTL:
+            del _RESULT_CACHE[key]
+            return None
+        _RESULT_CACHE.move_to_end(key)
+        return result
+
+def _cache_result(key: tuple, result: str):
+    with _RESULT_CACHE_LOCK:
+        _RESULT_CACHE[key] = (time.monotonic(), result)
+        _RESULT_CACHE.move_to_end(key)
+        while len(_RESULT_CACHE) > LOKI_RESULT_CACHE_SIZE:
+            _RESULT_CACHE.popitem(last=False)
+
+def _step_seconds(time_range_minutes: int) -> int:
+    """
+    Returns the metric query step for the full time range.
+
+    Loki's default is range / 250, but it is derived per request, so shards would each get a far
+    finer step than the unsharded query. The step is rounded up to a divisor (or, for very long
+    ranges, a multiple) of the shard length, so all shards evaluate on one shared grid.
+    """
+    step = max(time_range_minutes * 60 // 250, 1)
+    shard_seconds = LOKI_SHARD_MINUTES * 60
+    if step >= shard_seconds:
+        return -(-step // shard_seconds) * shard_seconds
+    return next(d for d in range(step, shard_seconds + 1) if shard_seconds % d == 0)
+
+def _build_params(query: str, time_range_minutes: int, limit: int, direction: str) -> dict:
+    """Builds the query_range parameters for the given tool arguments."""
+    # Read the clock once and stay in integer nanoseconds, so the range is exact and end - start
+    # is always time_range_minutes (no float rounding, no drift between two datetime.now() calls).
+    end_time_ns = time.time_ns()
+    start_time_ns = end_time_ns - time_range_minutes * 60 * NS_PER_SECOND
+
+    return {
+        "query": query,
+        "limit": limit,
+        "start": start_time_ns,
+        "end": end_time_ns,
+        "direction": direction,
+        "step": _step_seconds(time_range_minutes), # For matrix queries (e.g., rate, count_over_time)
+        "interval": "1m" # For stream queries, it limits the resolution.
+    }
+
+def _is_log_query(query: str) -> bool:
+    # A LogQL log query always starts with its stream selector; metric queries start with an
+    # aggregation or range function (e.g. `sum by (app) (...)`, `count_over_time(...)`).
+    return query.lstrip().startswith("{")
+
+def _shard_params(params: dict, time_range_minutes: int) -> List[dict]:
+    """
+    Splits long metric query time ranges into consecutive LOKI_SHARD_MINUTES sub-ranges.
+
+    Loki executes a single query_range request mostly serially, so for long ranges it is
+    faster to issue several shorter requests concurrently and merge them client-side
+    (the same approach as Loki's own `split_queries_by_interval`).
+
+    Log queries are not split: each shard would have to be sent the full limit, so a long range
+    would download up to (shards x limit) lines only to keep `limit` of them.
+    """
+    if time_range_minutes <= LOKI_SHARD_THRESHOLD_MINUTES or _is_log_query(params["query"]):
+        return [params]
+
+    # Shards are a whole number of steps long, so every shard starts on the query's step grid
+    shard_ns = max(LOKI_SHARD_MINUTES * 60, params["step"]) * NS_PER_SECOND
+    return [
+        {**params, "start": shard_start, "end": min(shard_start + shard_ns, params["end"])}
+        for shard_start in range(params["start"], params["end"], shard_ns)
+    ]
+
+def _merge_results(responses: List[dict]) -> dict:
+    """Merges the decoded responses of sharded metric queries into one query_range response."""
+    if len(responses) == 1:
+        return responses[0]
+
+    result_type = responses[0]["data"]["resultType"]
+    merged = []
+    if result_type == "matrix":
+        # Adjacent shards both evaluate the step at their shared boundary; keep one sample.
+        series = {}
+        for response in responses:
+            for item in response["data"]["result"]:
+                key = tuple(sorted(item["metric"].items()))
+                metric, samples = series.setdefault(key, (item["metric"], {}))
+                samples.update((v[0], v[1]) for v in item["values"])
+        merged = [
+            {"metric": metric, "values": [[ts, samples[ts]] for ts in sorted(samples, key=float)]}
+            for metric, samples in series.values()
+        ]
+
+    else:
+        for response in responses:
+            merged.extend(response["data"]["result"])
+
+    return {"data": {"resultType": result_type, "result": merged}}
+
+@lru_cache(maxsize=1)
+def _template_miner_config() -> TemplateMinerConfig:
+    # Built once; TemplateMinerConfig() uses drain3's defaults without looking for a drain3.ini.
+    return TemplateMinerConfig()
+
+def _fill_template(template: str, params: List[str]) -> Optional[str]:
+    parts = template.split("<*>")
+    if len(parts) != len(params) + 1:
+        return None
+    return "".join(part + param for part, param in zip(parts, params)) + parts[-1]
+
+def _mine_templates(lines: List[str]) -> Tuple[Dict[str, str], List[Optional[Tuple[str, List[str]]]]]:
+    """
+    Groups log lines into Drain templates, e.g. "ERROR connection refused to host=<*>".
+
+    Only templates shared by several lines are used. Drain also collapses whitespace, so a line
+    is kept verbatim when its template and parameters would not reproduce it exactly.
+
+    Returns:
+        A dict of template ID -> template for the templates used, and per line either a
+        (template ID, variable fields) pair or None if the line is kept verbatim.
+    """
+    # A fresh in-memory miner per call: template IDs only have to be consistent within one
+    # result, so there is no state to persist, lock or bound across calls.
+    miner = TemplateMiner(config=_template_miner_config())
+    cluster_ids = [miner.add_log_message(line)["cluster_id"] for line in lines]
+    # Templates can still generalize while the lines above are added, so only read
+    # them back (and extract parameters against them) once all lines are mined.
+    templates = {
+        cluster_id: miner.drain.id_to_cluster[cluster_id].get_template()
+        for cluster_id, size in Counter(cluster_ids).items() if size > 1
+    }
+
+    events = []
+    used = set()
+    for cluster_id, line in zip(cluster_ids, lines):
+        template = templates.get(cluster_id)
+        if template is not None:
+            params = [param.value for param in miner.extract_parameters(template, line, exact_matching=False) or []]
+            if _fill_template(template, params) == line:
+                events.append((str(cluster_id), params))
+                used.add(cluster_id)
+                continue
+        events.append(None)
+
+    return {str(cluster_id): templates[cluster_id] for cluster_id in used}, events
+
+@lru_cache(maxsize=1)
+def _token_encoder() -> Optional[tiktoken.Encoding]:
+    # gpt-4o's encoding; for other models (e.g. Llama via Ollama) it is a close enough estimate.
+    # tiktoken downloads the encoding on first use, so without network access (and no files in
+    # TIKTOKEN_CACHE_DIR) fall back to a characters-per-token estimate instead of failing the query.
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        print(f"DEBUG: tiktoken encoding unavailable ({e}), estimating {CHARS_PER_TOKEN} characters per token")
+        return None
+
+def _count_tokens(text: str) -> int:
+    encoder = _token_encoder()
+    if encoder is None:
+        return len(text) // CHARS_PER_TOKEN
+    # Log lines are arbitrary text, so special-token markers in them are counted as plain text.
+    return len(encoder.encode(text, disallowed_special=()))
+
+def _fits_budget(text: str) -> bool:
+    return _count_tokens(text) <= int(os.getenv("LOKI_TOKEN_BUDGET", DEFAULT_TOKEN_BUDGET))
+
+def _largest_fitting(render: Callable[[int], str], high: int) -> Tuple[int, str]:
+    """Returns (n, render(n)) for the largest n in 1..high whose output fits the token budget, else (0, render(0))."""
+    best_n, best = 0, render(0)
+    low = 1
+    while low <= high:
+        mid = (low + high) // 2
+        candidate = render(mid)
+        if _fits_budget(candidate):
+            best_n, best, low = mid, candidate, mid + 1
+        else:
+            high = mid - 1
+    return best_n, best
+
+def _dumps_within_budget(build: Callable[[int], dict], total: int, unit: str) -> str:
+    """
+    Serializes build(total), or if that exceeds the token budget, build(n) for the largest n that fits.
+
+    Args:
+        build: Returns the payload with at most n of the `total` entries kept.
+        total: Number of entries available.
+        unit: What an entry is, for the truncation marker (e.g. "lines").
+    """
+    # Compact encoding: the output is read by the LLM, so indentation only costs tokens.
+    output = orjson.dumps(build(total)).decode()
+    if _fits_budget(output):
+        return output
+
+    def truncated(n: int) -> str:
+        payload = build(n)
+        payload["truncated"] = f"[truncated: {n} of {total} {unit}]"
+        return orjson.dumps(payload).decode()
+
+    return _largest_fitting(truncated, total - 1)[1]
+
+def _latest_value(series: Tuple[str, list]) -> float:
+    values = series[1]
+    try:
+        return float(values[-1][1]) if values else float("-inf")
+    except ValueError:
+        return float("-inf")
+
+@lru_cache(maxsize=4096)
+def _format_timestamp(seconds: int) -> str:
+    # Formats straight from the struct_time instead of building a datetime per entry; cached
+    # because consecutive log entries and metric steps often fall on the same second.
+    return TIMESTAMP_FORMAT % time.localtime(seconds)[:6]
+
+def _format_response(data: dict, direction: str) -> str:
+    """Formats a decoded Loki query_range response into the string handed back to the LLM."""
+    # Check if the query returned a stream (log lines) or a matrix/vector (metrics)
+    if data["data"]["resultType"] == "streams":
+        if not data["data"]["result"]:
+            return "No log streams found for the given query and time range."
+        
+        # Lines are mined across all streams at once, so templates are shared between streams
+        labels = []
+        timestamps = []
+        lines = []
+        # (timestamp ns, stream index, entry index) of every entry, to truncate in query order below
+        order = []
+        for stream_index, stream in enumerate(data["data"]["result"]):
+            labels.append(", ".join([f'{k}="{v}"' for k, v in stream["stream"].items()]))
+            # Timestamps are integer nanoseconds; floor-divide to seconds instead of float division.
+            stream_ns = [int(entry[0]) for entry in stream["values"]]
+            timestamps.append([_format_timestamp(ns // NS_PER_SECOND) for ns in stream_ns])
+            lines.extend([entry[1] for entry in stream["values"]])
+            order.extend((ns, stream_index, entry_index) for entry_index, ns in enumerate(stream_ns))
+
+        # Replace repeated line structures by template IDs plus their variable fields
+        templates, events = _mine_templates(lines)
+        events = iter(events)
+        lines = iter(lines)
+        # Grouped per stream, so each stream's labels are written once rather than on every entry
+        grouped = []
+        for stream_labels, stream_timestamps in zip(labels, timestamps):
+            entries = []
+            for timestamp in stream_timestamps:
+                event, line = next(events), next(lines)
+                entries.append([timestamp, line] if event is None else [timestamp, event[0], event[1]])
+            grouped.append((stream_labels, entries))
+        # Truncation keeps the first n entries across all streams in the query's direction
+        # (newest first for "backward"), the same order Loki applies the limit in.
+        order.sort(key=lambda e: e[0], reverse=direction == "backward")
+
+        def build(n: int) -> dict:
+            kept = {}
+            for _, stream_index, entry_index in order[:n]:
+                kept.setdefault(stream_index, []).append(entry_index)
+            kept_streams = []
+            used = set()
+            for stream_index in sorted(kept):
+                stream_labels, entries = grouped[stream_index]
+                logs = [entries[entry_index] for entry_index in sorted(kept[stream_index])]
+                used.update(entry[1] for entry in logs if len(entry) == 3)
+                kept_streams.append({"labels": stream_labels, "logs": logs})
+            kept_templates = {template_id: t for template_id, t in templates.items() if template_id in used}
+            return {"type": "streams", "templates": kept_templates, "streams": kept_streams}
+
+        return _dumps_within_budget(build, len(order), "lines")
+
+    elif data["data"]["resultType"] in ["matrix", "vector"]:
+        if not data["data"]["result"]:
+            return "No metric data found for the given query and time range."
+        
+        # Format matrix/vector results
+        formatted_metrics = []
+        for item in data["data"]["result"]:
+            labels = ", ".join([f'{k}="{v}"' for k, v in item["metric"].items()])
+            # (timestamp, value) pairs rather than a dict per sample: half the bytes/tokens, no per-sample dict
+            values = [(_format_timestamp(int(float(v[0]))), v[1]) for v in item["values"]]
+            formatted_metrics.append((labels, values))
+
+        total_samples = max(len(values) for _, values in formatted_metrics)
+
+        def build(series: list, n: int) -> dict:
+            # Keeps the newest n samples of each of the given series
+            return {
+                "type": "metrics",
+                "data": [{"labels": labels, "values": values[max(len(values) - n, 0):]} for labels, values in series],
+            }
+
+        # Truncate within each series first, so every series stays represented
+        def truncated_samples(n: int) -> str:
+            payload = build(formatted_metrics, n)
+            payload["truncated"] = f"[truncated: {n} of {total_samples} samples per series]"
+            return orjson.dumps(payload).decode()
+
+        output = orjson.dumps(build(formatted_metrics, total_samples)).decode()
+        if _fits_budget(output):
+            return output
+        kept_samples, output = _largest_fitting(truncated_samples, total_samples - 1)
+        if kept_samples > 0:
+            return output
+
+        # Even one sample per series is over budget (e.g. `sum by (pod)` over many pods, where the labels
+        # alone are too large): keep the newest sample of as many series as fit, largest values first.
+        ranked = sorted(formatted_metrics, key=_latest_value, reverse=True)
+
+        def truncated_series(n: int) -> str:
+            payload = build(ranked[:n], 1)
+            payload["truncated"] = (
+                f"[truncated: {n} of {len(ranked)} series (largest latest value first), "
+                f"1 of {total_samples} samples per series]"
+            )
+            return orjson.dumps(payload).decode()
+
+        return _largest_fitting(truncated_series, len(ranked))[1]
+        
+    else:
+        return f"Loki query returned unsupported result type: {data['data']['resultType']}"
+
+def _merge_and_format(responses: List[dict], direction: str) -> str:
+    return _format_response(_merge_results(responses), direction)
+
+class _IncrementalDecoder:
+    """
+    Decodes a query_range response chunk by chunk with ijson.
+
+    Only data.resultType and the entries of data.result are materialized, so neither the raw
+    body nor the rest of the document (e.g. the query statistics) is ever held in memory.
+
+    The decoded entries are still collected into one list, since merging, template mining and
+    truncation need the whole result. Peak memory is therefore the decoded result (at most `limit`
+    log lines, which Loki enforces since log queries are not sharded), not one entry: what is saved
+    is holding the raw, possibly multi-megabyte body next to its decoded copy.
+    """
+
+    def __init__(self):
+        self._events = ijson.sendable_list()
+        self._parser = ijson.parse_coro(self._events, use_float=True)
+        self._builder = None
+        self._result_type = None
+        self._result = []
+
+    def feed(self, chunk: bytes):
+        self._parser.send(chunk)
+        self._consume()
+
+    def close(self) -> dict:
+        self._parser.close()
+        self._consume()
+        return {"data": {"resultType": self._result_type, "result": self._result}}
+
+    def _consume(self):
+        for prefix, event, value in self._events:
+            if self._builder is not None:
+                self._builder.event(event, value)
+                if prefix == "data.result.item" and event in ("end_map", "end_array"):
+                    self._result.append(self._builder.value)
+                    self._builder = None
+            elif prefix == "data.result.item" and event in ("start_map", "start_array"):
+                self._builder = ijson.ObjectBuilder()
+                self._builder.event(event, value)
+            elif prefix == "data.resultType":
+                self._result_type = value
+        del self._events[:]
+
+async def _close_at_loop_shutdown(client: httpx.AsyncClient) -> AsyncGenerator[None, None]:
+    # Stays suspended at the yield until the loop finalizes it in shutdown_asyncgens(), which
+    # asyncio.run() calls while the loop can still run the client's (async) cleanup.
+    try:
+        yield
+    finally:
+        _ASYNC_CLIENTS.pop(asyncio.get_running_loop(), None)
+        await client.aclose()
+
+async def _get_async_client() -> Tuple[httpx.AsyncClient, asyncio.Semaphore]:
+    """Returns the async client of the running event loop and its request slots, creating them if needed."""
+    loop = asyncio.get_running_loop()
+    # httpx.AsyncClient connections are bound to the loop they were opened on, so each loop gets
+    # its own client, closed when that loop shuts down instead of leaking its pooled connections.
+    entry = _ASYNC_CLIENTS.get(loop)
+    if entry is None:
+        client = httpx.AsyncClient(
+            headers=LOKI_HEADERS,
+            timeout=httpx.Timeout(LOKI_TIMEOUT[1], connect=LOKI_TIMEOUT[0]),
+            limits=httpx.Limits(max_connections=LOKI_MAX_CONNECTIONS, max_keepalive_connections=LOKI_MAX_CONNECTIONS),
+        )
+        # The loop only holds weak references to async generators, so keep the closer alive here.
+        entry = _ASYNC_CLIENTS[loop] = (client, asyncio.Semaphore(LOKI_MAX_CONNECTIONS), _close_at_loop_shutdown(client))
+        await entry[2].asend(None) # Runs it to the yield, which registers it with the loop
+    return entry[0], entry[1]
+
+def _fetch(api_url: str, params_list: List[dict]) -> List[dict]:
+    """Runs the (possibly sharded) requests on the shared session, in parallel threads."""
+    def fetch(params: dict) -> dict:
+        if params["limit"] < LOKI_STREAM_DECODE_MIN_LIMIT:
+            with _SESSION_SLOTS:
+                response = _SESSION.get(api_url, params=params, timeout=LOKI_TIMEOUT)
+            response.raise_for_status() # Raise an HTTPError for bad responses (4xx or 5xx)
+            # orjson parses the raw bytes several times faster than the stdlib json behind response.json().
+            # orjson.JSONDecodeError subclasses json.JSONDecodeError, so the tool's error handling still applies.
+            return orjson.loads(response.content)
+
+        with _SESSION_SLOTS, _SESSION.get(api_url, params=params, timeout=LOKI_TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            decoder = _IncrementalDecoder()
+            for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                decoder.feed(chunk)
+            return decoder.close()
+
+    if len(params_list) == 1:
+        return [fetch(params_list[0])]
+    with ThreadPoolExecutor(max_workers=min(_query_parallelism(), len(params_list))) as pool:
+        return list(pool.map(fetch, params_list))
+
+async def _afetch(api_url: str, params_list: List[dict]) -> List[dict]:
+    """Async counterpart of _fetch, running the shards concurrently on the shared async client."""
+    client, slots = await _get_async_client()
+    semaphore = asyncio.Semaphore(_query_parallelism())
+
+    async def fetch(params: dict) -> dict:
+        if params["limit"] < LOKI_STREAM_DECODE_MIN_LIMIT:
+            async with semaphore, slots:
+                response = await client.get(api_url, params=params)
+            response.raise_for_status() # Raise an HTTPStatusError for bad responses (4xx or 5xx)
+            return orjson.loads(response.content)
+
+        async with semaphore, slots, client.stream("GET", api_url, params=params) as response:
+            response.raise_for_status()
+            decoder = _IncrementalDecoder()
+            async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+                decoder.feed(chunk)
+            return decoder.close()
+
+    return await asyncio.gather(*[fetch(params) for params in params_list])
+
+class QueryLokiArgs(BaseModel):
+    """Arguments of the query_loki_logs tool, declared up front instead of inferred from the signature."""
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
+    query: str = Field(description="The LogQL query string.")
+    time_range_minutes: int = Field(default=60, description="How many minutes back from now to query.")
+    limit: int = Field(default=100, description="Maximum number of log lines to return.")
+    direction: Literal["forward", "backward"] = Field(
+        default="backward", description='"forward" for oldest first, "backward" for newest first.'
+    )
+    bypass_cache: bool = Field(default=False, description="Always fetch fresh results instead of reusing a recent identical call.")
+
+def _query_loki_logs(
     query: str,
     time_range_minutes: int = 60,
     limit: int = 100,
-    direction: str = "backward"
+    direction: Literal["forward", "backward"] = "backward",
+    bypass_cache: bool = False
 ) -> str:
     """
     Queries logs from Grafana Loki using LogQL.
@@ -30,90 +553,135 @@ def query_loki_logs(
         time_range_minutes (int): How many minutes back from now to query. Default is 60 minutes.
         limit (int): Maximum number of log lines to return. Default is 100.
         direction (str): Order of logs, "forward" for oldest first, "backward" for newest first. Default is "backward".
+        bypass_cache (bool): Set to true to always fetch fresh results from Loki. By default, repeating an
+                             identical call within the same minute returns the previous result.
 
     Returns:
         str: A JSON string of the log results, or an error message.
-             If query is for streams, returns log lines. If for metrics, returns aggregated data.
-             The output might be truncated if the limit is exceeded.
+             If query is for streams, returns log lines grouped per stream ("labels", "logs").
+             "templates" maps template IDs to line templates shared by several lines (variable parts
+             shown as <*>). Each log entry is either [timestamp, line] or
+             [timestamp, template ID, [values of the <*> fields in order]].
+             If for metrics, returns aggregated data: one entry per series with its labels and
+             a list of [timestamp, value] pairs.
+             The output might be truncated if the limit is exceeded, or if it is too large for the LLM's
+             context; a "truncated" field then says how many of the results were kept.
     """
     try:
-        end_time_ns = datetime.now().timestamp() * 1e9
-        start_time_ns = (datetime.now() - timedelta(minutes=time_range_minutes)).timestamp() * 1e9
-
         # Loki query_range API endpoint
-        api_url = f"{LOKI_URL}/loki/api/v1/query_range"
-        params = {
-            "query": query,
-            "limit": limit,
-            "start": int(start_time_ns),
-            "end": int(end_time_ns),
-            "direction": direction,
-            "interval": "1m" # For matrix queries (e.g., rate, count_over_time), allows step.
-                             # For stream queries, it limits the resolution.
-        }
+        api_url = f"{_loki_url()}/loki/api/v1/query_range"
+        params_list = _shard_params(_build_params(query, time_range_minutes, limit, direction), time_range_minutes)
 
-        print(f"DEBUG: Making Loki API call to {api_url} with query: {query}, time_range_minutes: {time_range_minutes}, limit: {limit}")
-
-        response = requests.get(api_url, params=params)
-        response.raise_for_status() # Raise an HTTPError for bad responses (4xx or 5xx)
-
-        data = response.json()
-
-        # Check if the query returned a stream (log lines) or a matrix/vector (metrics)
-        if data["data"]["resultType"] == "streams":
-            if not data["data"]["result"]:
-                return "No log streams found for the given query and time range."
-            
-            # Format stream results into a more readable string or JSON list
-            formatted_logs = []
-            for stream in data["data"]["result"]:
-                labels = ", ".join([f'{k}="{v}"' for k, v in stream["stream"].items()])
-                for entry in stream["values"]:
-                    timestamp_ns = int(entry[0])
-                    # Convert nanoseconds to datetime
-                    dt_object = datetime.fromtimestamp(timestamp_ns / 1e9)
-                    log_line = entry[1]
-                    formatted_logs.append(f"[{dt_object.strftime('%Y-%m-%d %H:%M:%S')}] {{{labels}}} {log_line}")
-            
-            return json.dumps({"type": "streams", "logs": formatted_logs}, indent=2)
-
-        elif data["data"]["resultType"] in ["matrix", "vector"]:
-            if not data["data"]["result"]:
-                return "No metric data found for the given query and time range."
-            
-            # Format matrix/vector results
-            formatted_metrics = []
-            for item in data["data"]["result"]:
-                labels = ", ".join([f'{k}="{v}"' for k, v in item["metric"].items()])
-                values = [{"timestamp": datetime.fromtimestamp(float(v[0])).strftime('%Y-%m-%d %H:%M:%S'), "value": v[1]} for v in item["values"]]
-                formatted_metrics.append({"labels": labels, "values": values})
-            
-            return json.dumps({"type": "metrics", "data": formatted_metrics}, indent=2)
-            
-        else:
-            return f"Loki query returned unsupported result type: {data['data']['resultType']}"
+        cache_key = _result_cache_key(query, time_range_minutes, limit, direction, params_list[-1]["end"])
+        if not bypass_cache:
+            cached = _cached_result(cache_key)
+            if cached is not None:
+                print(f"DEBUG: Returning cached Loki result for query: {query}")
+                return cached
 
+        print(f"DEBUG: Making Loki API call to {api_url} with query: {query}, time_range_minutes: {time_range_minutes}, limit: {limit}, shards: {len(params_list)}")
+
+        responses = _fetch(api_url, params_list)
+        result = _merge_and_format(responses, direction)
+        _cache_result(cache_key, result)
+        return result
+
+    except json.JSONDecodeError as e:
+        return f"Error: Loki returned invalid JSON response ({e.msg}). Response starts with: {e.doc[:ERROR_BODY_PREVIEW_CHARS]!r}"
+    except ijson.JSONError as e:
+        return f"Error: Loki returned invalid JSON response: {e}"
     except requests.exceptions.RequestException as e:
-        return f"Error connecting to Loki or API error: {e}. Check if Loki is running at {LOKI_URL}."
-    except json.JSONDecodeError:
-        return f"Error: Loki returned invalid JSON response. Response: {response.text}"
+        return f"Error connecting to Loki or API error: {e}. Check if Loki is running at {_loki_url()}."
+    except Exception as e:
+        return f"An unexpected error occurred: {e}"
+
+async def _aquery_loki_logs(
+    query: str,
+    time_range_minutes: int = 60,
+    limit: int = 100,
+    direction: Literal["forward", "backward"] = "backward",
+    bypass_cache: bool = False
+) -> str:
+    """Async counterpart of _query_loki_logs, awaited by AgentExecutor.ainvoke."""
+    try:
+        # Loki query_range API endpoint
+        api_url = f"{_loki_url()}/loki/api/v1/query_range"
+        params_list = _shard_params(_build_params(query, time_range_minutes, limit, direction), time_range_minutes)
+
+        cache_key = _result_cache_key(query, time_range_minutes, limit, direction, params_list[-1]["end"])
+        if not bypass_cache:
+            cached = _cached_result(cache_key)
+            if cached is not None:
+                print(f"DEBUG: Returning cached Loki result for query: {query}")
+                return cached
+
+        print(f"DEBUG: Making async Loki API call to {api_url} with query: {query}, time_range_minutes: {time_range_minutes}, limit: {limit}, shards: {len(params_list)}")
+
+        responses = await _afetch(api_url, params_list)
+        # Merging and formatting are CPU-bound (template mining, token counting), so run them
+        # in a worker thread to keep the event loop free for concurrent tool calls and streaming.
+        result = await asyncio.to_thread(_merge_and_format, responses, direction)
+        _cache_result(cache_key, result)
+        return result
+
+    except json.JSONDecodeError as e:
+        return f"Error: Loki returned invalid JSON response ({e.msg}). Response starts with: {e.doc[:ERROR_BODY_PREVIEW_CHARS]!r}"
+    except ijson.JSONError as e:
+        return f"Error: Loki returned invalid JSON response: {e}"
+    except httpx.HTTPError as e:
+        return f"Error connecting to Loki or API error: {e}. Check if Loki is running at {_loki_url()}."
     except Exception as e:
         return f"An unexpected error occurred: {e}"
 
+def _format_validation_error(e: ValidationError) -> str:
+    problems = "; ".join(f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" for err in e.errors())
+    return (
+        f"Error: invalid arguments for query_loki_logs ({problems}). Valid arguments are query, "
+        'time_range_minutes, limit, direction ("forward" or "backward") and bypass_cache.'
+    )
+
+# Registered with both a sync and an async implementation: AgentExecutor.invoke uses
+# the former, while ainvoke awaits the coroutine so parallel tool calls overlap on I/O.
+query_loki_logs = StructuredTool.from_function(
+    func=_query_loki_logs,
+    coroutine=_aquery_loki_logs,
+    name="query_loki_logs",
+    args_schema=QueryLokiArgs,
+    infer_schema=False,
+    return_direct=False,
+    # Report invalid arguments (unknown names, a direction other than forward/backward) back to
+    # the LLM as the tool's output, so it can correct the call instead of aborting the agent turn.
+    handle_validation_error=_format_validation_error,
+)
+
 # Example usage (for testing the tool directly)
 if __name__ == "__main__":
+    load_dotenv()
+    print("--- Testing the token budget with many metric series (offline) ---")
+    many_series = {"data": {"resultType": "matrix", "result": [
+        {
+            "metric": {"pod": f"checkout-{i:04d}-7f9c", "namespace": "production", "container": "checkout-service"},
+            "values": [[1700000000 + 60 * k, str(i + k)] for k in range(60)],
+        }
+        for i in range(500)
+    ]}}
+    result_budget = _format_response(many_series, "backward")
+    assert _fits_budget(result_budget), "many-series result exceeds LOKI_TOKEN_BUDGET"
+    assert '"pod=\\"checkout-0499-7f9c\\"' in result_budget, "the series with the largest latest value was dropped"
+    print(orjson.loads(result_budget)["truncated"])
+
     # Ensure Loki is running at http://localhost:3100
-    print("--- Testing basic stream query ---")
-    result = query_loki_logs(query='{job="system_logs"} |= "error"', time_range_minutes=10)
+    print("\n--- Testing basic stream query ---")
+    result = query_loki_logs.invoke({"query": '{job="system_logs"} |= "error"', "time_range_minutes": 10})
     print(result)
 
     print("\n--- Testing aggregated query (count errors over time) ---")
     # This requires Promtail to be sending logs to Loki and having some error logs.
     # Note: For `rate` or `count_over_time`, you generally need a range selector (e.g., [5m])
     # within the LogQL query itself for it to return a matrix.
-    result_agg = query_loki_logs(query='sum by (filename) (count_over_time({job="system_logs"} |= "error" [5m]))', time_range_minutes=60, limit=10)
+    result_agg = query_loki_logs.invoke({"query": 'sum by (filename) (count_over_time({job="system_logs"} |= "error" [5m]))', "time_range_minutes": 60, "limit": 10})
     print(result_agg)
 
     print("\n--- Testing non-existent query ---")
-    result_no_data = query_loki_logs(query='{job="nonexistent_app"}', time_range_minutes=1)
+    result_no_data = query_loki_logs.invoke({"query": '{job="nonexistent_app"}', "time_range_minutes": 1})
     print(result_no_data)
\ No newline at end of file